@@ -1,10 +1,20 @@
 import os
 import re
-import requests
+import time
+import asyncio
+import sqlite3
+import threading
+from contextlib import contextmanager
+import socket
+from urllib.parse import urlparse
+from string import Template
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
 import streamlit as st
 import json
-import concurrent.futures
-from openai import OpenAI, APIError, APITimeoutError, RateLimitError
+try:
+    import orjson # C 實作，序列化大型中文報告明顯較快
+except ImportError:
+    orjson = None
 
 # ==============================
 # 🔧 頁面設定 (Page Config)
@@ -70,18 +80,67 @@ st.title("🤖 YouTube 內容策略 AI 助理")
 # ==============================
 # 🔗 連結驗證函式 (新增)
 # ==============================
-def check_url_status(url):
-    """檢查單一 URL 的狀態，返回 True (有效) 或 False (無效)"""
+# 連結比對用的正規表示式，於模組載入時編譯一次
+_URL_RE = re.compile(r'https?://[^\s\)\>]+')
+
+# 連結驗證共用的請求標頭
+HTTP_HEADERS = {"User-Agent": "Mozilla/5.0 (compatible; YouTubeContentAssistant/1.0; +link-checker)"}
+
+# 整批連結驗證的總時間上限 (秒)，避免少數緩慢的主機拖慢整體
+LINK_CHECK_BUDGET = 8
+
+# LLM 常虛構的範例/佔位網域，直接視為無效
+BLOCKED_DOMAINS = ("example.com", "example.org", "example.net", "localhost", "yourwebsite.com")
+
+def is_checkable_url(url):
+    """
+    發送 HEAD 請求前的低成本檢查 (不做任何網路 I/O)：
+    格式錯誤、非 http(s) 或已知無效網域的連結直接視為無效。
+    無法解析的主機則在非同步驗證階段、整體時間預算內判斷。
+    """
     try:
-        # 使用 HEAD 請求，速度更快，因為它只獲取標頭
-        response = requests.head(url, allow_redirects=True, timeout=5)
-        # 狀態碼在 200-399 之間都視為有效
-        if 200 <= response.status_code < 400:
-            return True
-        else:
-            return False
-    except requests.RequestException:
+        parsed = urlparse(url)
+        host = parsed.hostname
+    except ValueError:
+        return False
+    if parsed.scheme not in ("http", "https") or not host:
         return False
+    return not any(host == d or host.endswith("." + d) for d in BLOCKED_DOMAINS)
+
+async def check_url_status(session, url, timeout):
+    """檢查單一 URL 的狀態，返回 ✅ (有效)、❌ (無效) 或 ⚠️ (驗證時發生錯誤)"""
+    import aiohttp
+
+    try:
+        # 使用 HEAD 請求，速度更快，因為它只獲取標頭
+        async with session.head(url, allow_redirects=True, timeout=timeout) as response:
+            status = response.status
+    except aiohttp.ClientConnectorError as e:
+        # DNS 解析失敗 (LLM 虛構的網域) 視為無效，其他連線錯誤仍標示為 ⚠️
+        return "❌" if isinstance(e.os_error, socket.gaierror) else "⚠️"
+    except Exception:
+        return "⚠️"
+    # 狀態碼在 200-399 之間都視為有效
+    return "✅" if 200 <= status < 400 else "❌"
+
+async def verify_all(urls):
+    """以單一 event loop 同時驗證所有連結，回傳 {url: 狀態圖示}"""
+    import aiohttp # 只有在驗證連結時才載入
+
+    # 本次驗證中，同一主機的請求共用保持開啟的連線
+    connector = aiohttp.TCPConnector(limit=50)
+    timeout = aiohttp.ClientTimeout(total=5)
+    async with aiohttp.ClientSession(connector=connector, headers=HTTP_HEADERS) as session:
+        tasks = {asyncio.create_task(check_url_status(session, url, timeout)): url for url in urls}
+        # 以整體時間預算限制最差情況，超時未完成的連結標示為 ⚠️
+        done, not_done = await asyncio.wait(tasks, timeout=LINK_CHECK_BUDGET)
+        for task in not_done:
+            task.cancel()
+        await asyncio.gather(*not_done, return_exceptions=True)
+
+    statuses = {tasks[task]: task.result() for task in done}
+    statuses.update({tasks[task]: "⚠️" for task in not_done})
+    return statuses
 
 # ==============================
 # 🔑 API 金鑰與狀態初始化
@@ -93,11 +152,17 @@ except (FileNotFoundError, KeyError):
     st.error("錯誤：請先在 .streamlit/secrets.toml 中設定您的 OPENROUTER_API_KEY。")
     st.stop()
 
-# --- 初始化 OpenAI Client ---
-client = OpenAI(
-  base_url="https://openrouter.ai/api/v1",
-  api_key=OPENROUTER_API_KEY,
-)
+# --- OpenAI Client (延遲初始化，只有在實際呼叫 API 時才載入 openai) ---
+# 以 st.cache_resource 快取，讓所有重跑與 session 共用同一個 client 及其連線池
+@st.cache_resource
+def get_client():
+    from openai import OpenAI
+    return OpenAI(
+      base_url="https://openrouter.ai/api/v1",
+      api_key=OPENROUTER_API_KEY,
+      timeout=1200.0,
+      max_retries=0, # 重試交由 tenacity 統一處理
+    )
 
 
 # 初始化 session_state
@@ -109,69 +174,456 @@ if 'research_result' not in st.session_state:
     st.session_state.research_result = {}
 if 'field_selection' not in st.session_state:
     st.session_state.field_selection = "自動探索當前美股熱門議題" # 預設值
+if 'discovered_topics_by_field' not in st.session_state:
+    st.session_state.discovered_topics_by_field = {}
+if 'batch_research_notices' not in st.session_state:
+    st.session_state.batch_research_notices = [] # 整頁重跑後仍要顯示的批次研究結果訊息
+if 'url_status_cache' not in st.session_state:
+    st.session_state.url_status_cache = {} # {url: (狀態圖示, 檢查時間)}
+
+# 連結驗證結果的快取有效時間 (秒)
+URL_STATUS_TTL = 3600
 
 
-# 儲存研究結果的檔案
-storage_file = "research_results.json"
+# 儲存研究結果的資料庫，以及只做附加寫入的 JSONL 紀錄檔
+# (資料庫為空時會從紀錄檔重建)
+storage_db = "research_results.db"
+storage_file = "research_results.jsonl"
 
 # ==============================
 # 📂 資料存取函式
 # ==============================
-def load_stored_data():
-    """從 JSON 檔案載入已儲存的研究結果"""
-    if os.path.exists(storage_file):
-        with open(storage_file, "r", encoding="utf-8") as f:
+# 每次存取都開啟獨立的短連線，由 SQLite (WAL) 處理多個 session 的並行讀寫，
+# 不在 session 之間共用連線或交易
+@st.cache_resource
+def init_db():
+    """建立資料表並從 JSONL 紀錄檔匯入 (整個程序只執行一次)"""
+    conn = sqlite3.connect(storage_db, timeout=30)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL") # 寫入資料庫檔案，之後的連線都沿用
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS research ("
+            "topic TEXT PRIMARY KEY, perplexity_result TEXT, ts INTEGER)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS topic_cache ("
+            "field TEXT, embedding BLOB, response TEXT, ts INTEGER)"
+        )
+        _import_jsonl(conn)
+    finally:
+        conn.close()
+    return True
+
+@contextmanager
+def db_connection():
+    """開啟一條只供本次操作使用的 SQLite 連線，用完即關閉"""
+    init_db()
+    conn = sqlite3.connect(storage_db, timeout=30)
+    try:
+        conn.execute("PRAGMA synchronous=NORMAL")
+        yield conn
+    finally:
+        conn.close()
+
+def _dumps_line(entry):
+    """將一筆資料序列化為 UTF-8 編碼的 JSONL 行"""
+    if orjson is not None:
+        return orjson.dumps(entry) + b"\n"
+    return (json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8")
+
+def _loads_line(line):
+    return orjson.loads(line) if orjson is not None else json.loads(line)
+
+def _read_jsonl():
+    """逐行讀取 JSONL 紀錄檔，同一主題以最後一筆為準"""
+    data = {}
+    if not os.path.exists(storage_file):
+        return data
+    with open(storage_file, "rb") as f:
+        for line in f:
             try:
-                return json.load(f)
-            except json.JSONDecodeError:
-                return {}
-    return {}
+                entry = _loads_line(line)
+            except ValueError: # 涵蓋 json/orjson 的 JSONDecodeError 與編碼錯誤
+                continue # 略過寫入中斷造成的不完整行
+            data[entry["topic"]] = entry["perplexity_result"]
+    return data
+
+def _import_jsonl(conn):
+    """資料庫為空時，從 JSONL 紀錄檔匯入研究結果"""
+    if conn.execute("SELECT 1 FROM research LIMIT 1").fetchone():
+        return
+    data = _read_jsonl()
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO research VALUES (?, ?, strftime('%s','now'))",
+            list(data.items())
+        )
+
+def _append_jsonl(topic, perplexity_result):
+    """將一筆研究結果附加到 JSONL 紀錄檔，不需重寫整個檔案"""
+    entry = {"topic": topic, "perplexity_result": perplexity_result}
+    with open(storage_file, "ab") as f:
+        f.write(_dumps_line(entry))
+
+@st.cache_data(show_spinner=False)
+def _fetch_topics():
+    with db_connection() as conn:
+        rows = conn.execute("SELECT topic FROM research ORDER BY ts").fetchall()
+    return [row[0] for row in rows]
+
+@st.cache_data(show_spinner=False)
+def _fetch_result(topic):
+    with db_connection() as conn:
+        row = conn.execute(
+            "SELECT perplexity_result FROM research WHERE topic=?", (topic,)
+        ).fetchone()
+    return row[0] if row else None
+
+class StoredResearch:
+    """以 dict 介面存取已儲存的研究結果，內容在需要時才從資料庫讀取"""
+
+    def keys(self):
+        return _fetch_topics()
+
+    def __contains__(self, topic):
+        return _fetch_result(topic) is not None
+
+    def __getitem__(self, topic):
+        result = _fetch_result(topic)
+        if result is None:
+            raise KeyError(topic)
+        return {"perplexity_result": result}
+
+def load_stored_data():
+    """載入已儲存的研究結果"""
+    return StoredResearch()
 
 def save_result(topic, perplexity_result):
-    """將新的研究結果儲存到 JSON 檔案"""
-    data = load_stored_data()
-    data[topic] = {
-        "perplexity_result": perplexity_result
-    }
-    with open(storage_file, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    """將新的研究結果儲存到資料庫，並附加到 JSONL 紀錄檔"""
+    # JSONL 附加寫入放在交易內，由 SQLite 的寫入鎖確保各 session 的寫入不會交錯
+    with db_connection() as conn, conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO research VALUES (?, ?, strftime('%s','now'))",
+            (topic, perplexity_result)
+        )
+        _append_jsonl(topic, perplexity_result)
+    # 快取為所有 session 共用，儲存後立即失效，讓其他分頁讀到最新資料
+    _fetch_topics.clear()
+    _fetch_result.clear()
 
-stored_data = load_stored_data()
+# ==============================
+# 🧲 議題探索語意快取
+# ==============================
+# 相同或語意相近的領域 (例如「AI」與「人工智慧」) 直接重用先前的議題清單。
+# 議題具時效性，快取只保留 6 小時。
+EMBEDDING_MODEL = "openai/text-embedding-3-small"
+SEMANTIC_CACHE_THRESHOLD = 0.95
+SEMANTIC_CACHE_TTL = 6 * 3600
+
+def embed_texts(texts):
+    """以單一請求取得多段文字正規化後的向量 (依輸入順序)，失敗時回傳 None"""
+    import numpy as np
+
+    # 與聊天請求共用同一套名額、速率限制與重試機制；
+    # 向量只用於選用的語意快取，額滿時不顯示錯誤，直接略過快取
+    if not get_llm_semaphore().acquire(blocking=False):
+        return None
+    try:
+        response = _create_embedding(model=EMBEDDING_MODEL, input=list(texts))
+    except Exception as e:
+        print(f"Embedding error details: {e}")
+        return None
+    finally:
+        get_llm_semaphore().release()
+    vectors = np.asarray(
+        [item.embedding for item in sorted(response.data, key=lambda item: item.index)],
+        dtype=np.float32
+    )
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def embed_text(text):
+    """透過 OpenRouter 取得正規化後的文字向量，失敗時回傳 None"""
+    vectors = embed_texts([text])
+    return vectors[0] if vectors is not None else None
+
+def lookup_topic_cache(query_vector):
+    """回傳相似度超過門檻且未過期的議題清單，沒有則回傳 None"""
+    import numpy as np
+
+    with db_connection() as conn:
+        rows = conn.execute(
+            "SELECT embedding, response FROM topic_cache WHERE ts >= ?",
+            (int(time.time()) - SEMANTIC_CACHE_TTL,)
+        ).fetchall()
+    if not rows:
+        return None
+    keys = np.vstack([np.frombuffer(row[0], dtype=np.float32) for row in rows])
+    similarities = keys @ query_vector
+    best = int(np.argmax(similarities))
+    if similarities[best] > SEMANTIC_CACHE_THRESHOLD:
+        return rows[best][1]
+    return None
+
+def store_topic_cache(field, query_vector, response):
+    """寫入新的快取項目，並順便清除已過期的項目"""
+    now = int(time.time())
+    with db_connection() as conn, conn:
+        conn.execute("DELETE FROM topic_cache WHERE ts < ?", (now - SEMANTIC_CACHE_TTL,))
+        conn.execute(
+            "INSERT INTO topic_cache VALUES (?, ?, ?, ?)",
+            (field, query_vector.astype("float32").tobytes(), response, now)
+        )
 
 # ==============================
 # 🧠 LLM API 呼叫函式
 # ==============================
-def openrouter_chat(model, messages, temperature=0.7):
-    """使用 openai 函式庫呼叫 OpenRouter API"""
+def _report_api_error(e):
+    """將 API 呼叫的例外以使用者看得懂的訊息顯示出來"""
+    from openai import APIError, APITimeoutError, RateLimitError
+
+    if isinstance(e, APITimeoutError):
+        st.error(f"API 請求超時：伺服器在 {600} 秒內未完成回應。")
+    elif isinstance(e, RateLimitError):
+        st.error(f"API 速率限制錯誤：請稍後再試。 ({e})")
+    elif isinstance(e, APIError): # 捕捉更廣泛的 API 錯誤，例如伺服器錯誤 (5xx)
+        st.error(f"OpenRouter API 錯誤 (HTTP {e.status_code})：{e.message}")
+        print(f"API Error details: {e}")
+    else: # 捕捉其他潛在錯誤
+        st.error(f"呼叫 API 時發生未預期的錯誤: {e}")
+        print(f"Unexpected error details: {e}")
+
+# ------------------------------
+# 速率限制與重試
+# ------------------------------
+# 每分鐘允許送出的 LLM 請求數；會依 OpenRouter 回傳的 X-RateLimit-* 標頭動態調整
+LLM_REQUESTS_PER_MINUTE = 60
+
+class RateLimiter:
+    """Token bucket 速率限制器，同步與非同步呼叫端共用同一個額度"""
+
+    def __init__(self, max_rate, time_period=60):
+        self.capacity = max_rate
+        self.time_period = time_period
+        self.rate = max_rate / time_period
+        self.tokens = float(max_rate)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self):
+        """預約一個額度，回傳需要等待的秒數 (額度可預支為負值以排隊)"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def acquire(self):
+        time.sleep(self._reserve())
+
+    async def acquire_async(self):
+        await asyncio.sleep(self._reserve())
+
+    def update_from_headers(self, headers):
+        """依回應標頭調整額度：遵守 Retry-After，並以剩餘次數為上限"""
+        if not headers:
+            return
+        with self._lock:
+            limit = headers.get("x-ratelimit-limit")
+            if limit and limit.isdigit() and int(limit) > 0:
+                self.capacity = int(limit)
+                self.rate = self.capacity / self.time_period
+            remaining = headers.get("x-ratelimit-remaining")
+            if remaining and remaining.isdigit():
+                self.tokens = min(self.tokens, float(remaining))
+            retry_after = headers.get("retry-after")
+            try:
+                if retry_after:
+                    self.tokens = min(self.tokens, -float(retry_after) * self.rate)
+            except ValueError:
+                pass
+
+@st.cache_resource
+def get_rate_limiter():
+    """所有 session 共用同一個 API 金鑰，因此也共用同一個速率限制器"""
+    return RateLimiter(LLM_REQUESTS_PER_MINUTE)
+
+def _is_retryable(e):
+    """429、5xx 與連線錯誤才重試；超時 (已等待 20 分鐘) 與 4xx 直接回報"""
+    from openai import APIConnectionError, APIStatusError, APITimeoutError, RateLimitError
+
+    if isinstance(e, RateLimitError):
+        response = getattr(e, "response", None)
+        get_rate_limiter().update_from_headers(response.headers if response is not None else None)
+        return True
+    if isinstance(e, APIStatusError):
+        return e.status_code >= 500
+    return isinstance(e, APIConnectionError) and not isinstance(e, APITimeoutError)
+
+_retry_policy = retry(
+    wait=wait_random_exponential(min=1, max=60),
+    stop=stop_after_attempt(5),
+    retry=retry_if_exception(_is_retryable),
+    reraise=True,
+)
+
+@_retry_policy
+def _create_completion(**kwargs):
+    limiter = get_rate_limiter()
+    limiter.acquire()
+    raw = get_client().chat.completions.with_raw_response.create(**kwargs)
+    limiter.update_from_headers(raw.headers)
+    return raw.parse()
+
+@_retry_policy
+def _create_embedding(**kwargs):
+    limiter = get_rate_limiter()
+    limiter.acquire()
+    raw = get_client().embeddings.with_raw_response.create(**kwargs)
+    limiter.update_from_headers(raw.headers)
+    return raw.parse()
+
+@_retry_policy
+async def _create_completion_async(async_client, **kwargs):
+    limiter = get_rate_limiter()
+    await limiter.acquire_async()
+    raw = await async_client.chat.completions.with_raw_response.create(**kwargs)
+    limiter.update_from_headers(raw.headers)
+    return raw.parse() # 非同步 client 的 raw response 也是同步 parse
+
+def _extract_content(completion):
+    """取出回應內容，格式不符時回傳 None"""
+    content = completion.choices[0].message.content
+    if content is None:
+         st.error("API 回應格式錯誤：在回傳資料中找不到 'content'。")
+         print("Received unexpected response structure:", completion)
+    return content
+
+# ------------------------------
+# 全域同時請求上限
+# ------------------------------
+# 多位使用者同時執行 Deep Research 時，超過上限的請求直接婉拒，
+# 而不是讓所有人一起排隊、一起變慢
+MAX_CONCURRENT_LLM = int(os.environ.get("MAX_CONCURRENT_LLM", "3"))
+
+@st.cache_resource
+def get_llm_semaphore():
+    """跨 session 共用的 semaphore，限制整個服務同時進行中的 LLM 請求數"""
+    return threading.BoundedSemaphore(MAX_CONCURRENT_LLM)
+
+def _acquire_llm_slot():
+    """嘗試取得一個請求名額，額滿時顯示提示並回傳 False"""
+    if get_llm_semaphore().acquire(blocking=False):
+        return True
+    st.error("系統繁忙，請稍後再試")
+    return False
+
+class LLMStreamError(Exception):
+    """串流未能完整結束 (額滿、API 錯誤或中途斷線)；錯誤訊息已顯示給使用者"""
+
+def openrouter_chat(model, messages, temperature=0.7, stream=False):
+    """
+    使用 openai 函式庫呼叫 OpenRouter API。
+    stream=True 時回傳逐段產出文字的 generator，可直接交給 st.write_stream；
+    串流未完整結束時會在最後拋出 LLMStreamError，呼叫端不應儲存已收到的部分內容。
+    """
+    if stream:
+        return _openrouter_chat_stream(model, messages, temperature)
+    if not _acquire_llm_slot():
+        return None
     try:
-        completion = client.chat.completions.create(
+        completion = _create_completion(
             model=model,
             messages=messages,
             temperature=temperature,
             timeout=1200
         )
-        content = completion.choices[0].message.content
-        if content is None:
-             st.error("API 回應格式錯誤：在回傳資料中找不到 'content'。")
-             print("Received unexpected response structure:", completion)
-             return None
-        return content
-
-    except APITimeoutError:
-        st.error(f"API 請求超時：伺服器在 {600} 秒內未完成回應。")
+        return _extract_content(completion)
+    except Exception as e:
+        _report_api_error(e)
         return None
-    except RateLimitError as e:
-        st.error(f"API 速率限制錯誤：請稍後再試。 ({e})")
-        return None
-    except APIError as e: # 捕捉更廣泛的 API 錯誤，例如伺服器錯誤 (5xx)
-        st.error(f"OpenRouter API 錯誤 (HTTP {e.status_code})：{e.message}")
-        print(f"API Error details: {e}")
-        return None
-    except Exception as e: # 捕捉其他潛在錯誤
-        st.error(f"呼叫 API 時發生未預期的錯誤: {e}")
-        print(f"Unexpected error details: {e}")
+    finally:
+        get_llm_semaphore().release()
+
+def _openrouter_chat_stream(model, messages, temperature):
+    if not _acquire_llm_slot():
+        raise LLMStreamError("no free LLM slot")
+    finish_reason = None
+    try:
+        chunks = _create_completion(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            timeout=1200,
+            stream=True
+        )
+        for chunk in chunks:
+            if chunk.choices:
+                finish_reason = chunk.choices[0].finish_reason or finish_reason
+                yield chunk.choices[0].delta.content or ""
+    except Exception as e:
+        _report_api_error(e)
+        raise LLMStreamError(str(e)) from e
+    finally:
+        get_llm_semaphore().release()
+    if finish_reason is None:
+        # 連線在模型完成前就結束，收到的只是部分內容
+        st.error("API 回應中斷：內容未完整傳回，請稍後再試。")
+        raise LLMStreamError("stream ended without finish_reason")
+
+async def openrouter_chat_async(async_client, model, messages, temperature=0.7):
+    """openrouter_chat 的非同步版本，供多個請求同時發送使用"""
+    try:
+        completion = await _create_completion_async(
+            async_client,
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            timeout=1200
+        )
+        return _extract_content(completion)
+    except Exception as e:
+        _report_api_error(e)
         return None
 
+# 同時進行中的 LLM 請求上限，避免超過 OpenRouter 的速率限制
+MAX_CONCURRENT_REQUESTS = 5
+
+def run_many(coro_factories, limit=MAX_CONCURRENT_REQUESTS):
+    """
+    以 asyncio 同時執行多個 LLM 請求，並依原順序回傳結果。
+    coro_factories 中的每個元素接收 AsyncOpenAI client 並回傳 coroutine。
+    每個請求各自佔用一個全域名額；取不到名額的請求不執行，結果為 None。
+    """
+    from openai import AsyncOpenAI
+
+    llm_semaphore = get_llm_semaphore()
+    skipped = []
+
+    async def _runner():
+        # Semaphore 與 AsyncOpenAI 都綁定在本次的 event loop 上
+        semaphore = asyncio.Semaphore(limit)
+        async with AsyncOpenAI(
+            base_url="https://openrouter.ai/api/v1",
+            api_key=OPENROUTER_API_KEY,
+            max_retries=0,
+        ) as async_client:
+            async def _bounded(factory):
+                async with semaphore:
+                    if not llm_semaphore.acquire(blocking=False):
+                        skipped.append(factory)
+                        return None
+                    try:
+                        return await factory(async_client)
+                    finally:
+                        llm_semaphore.release()
+            return await asyncio.gather(*(_bounded(f) for f in coro_factories))
+
+    results = asyncio.run(_runner())
+    if skipped:
+        st.error(f"系統繁忙，有 {len(skipped)} 個請求未能執行，請稍後再試")
+    return results
+
 # ==============================
 # 📝 Prompt 模板
 # ==============================
@@ -307,59 +759,252 @@ SCRIPT_PROMPT_TEMPLATE = """
 6.  **語氣 (Tone):** 口語化、有觀點、像一個聰明的朋友在為您深入解析，但不會太嚴肅。
 """
 
+# 模板於載入時預先編譯；以 $ 取代 {} 作為佔位符，
+# 並使用 safe_substitute：日後在模板中加入大括號 (例如 JSON 範例) 或
+# 美元符號 (例如 $100、$NVDA) 都會原樣保留，不會導致格式化失敗
+_DISCOVER_TPL = Template(DISCOVER_PROMPT_TEMPLATE.replace("{field}", "$field"))
+_RESEARCH_TPL = Template(RESEARCH_PROMPT_TEMPLATE.replace("{topic}", "$topic"))
+_SCRIPT_TPL = Template(
+    SCRIPT_PROMPT_TEMPLATE.replace("{topic}", "$topic").replace("{final_summary}", "$final_summary")
+)
+
 # ==============================
 # 🤖 Agent 核心功能函式
 # ==============================
 def discover_topics(field):
-    prompt = DISCOVER_PROMPT_TEMPLATE.format(field=field)
-    return openrouter_chat(
+    query_vector = embed_text(field)
+    if query_vector is not None:
+        cached = lookup_topic_cache(query_vector)
+        if cached:
+            return cached
+
+    prompt = _DISCOVER_TPL.safe_substitute(field=field)
+    topics_text = openrouter_chat(
         model="perplexity/sonar-pro",
         messages=[{"role":"user","content":prompt}]
     )
+    if topics_text and query_vector is not None:
+        store_topic_cache(field, query_vector, topics_text)
+    return topics_text
+
+# 批次探索時，要求模型在各領域的輸出之間插入的分隔標記
+FIELD_SEPARATOR = "---FIELD-SEPARATOR---"
+
+def discover_topics_batch(fields):
+    """
+    以單一請求同時為多個領域生成議題清單，回傳 {領域: 議題清單文本}。
+    語意快取中已有的領域直接取用，只將其餘領域合併送出。
+    """
+    results = {}
+    pending = []
+    # 所有領域的向量以一次請求取得，不為每個領域各自往返一次
+    vectors = embed_texts(fields)
+    for i, field in enumerate(fields):
+        query_vector = vectors[i] if vectors is not None else None
+        cached = lookup_topic_cache(query_vector) if query_vector is not None else None
+        if cached:
+            results[field] = cached
+        else:
+            pending.append((field, query_vector))
 
-def search_with_perplexity(topic):
-    prompt = RESEARCH_PROMPT_TEMPLATE.format(topic=topic)
+    if pending:
+        field_blocks = "\n".join(
+            f"### Field {i}: {field}" for i, (field, _) in enumerate(pending, start=1)
+        )
+        prompt = (
+            _DISCOVER_TPL.safe_substitute(field="請分別針對下方列出的每一個領域進行研究")
+            + f"\n\n{field_blocks}\n\n"
+            + "請依照上方領域的順序，為每個領域各自產出一份完整的議題推薦清單，"
+            + f"並在不同領域的清單之間單獨一行輸出 `{FIELD_SEPARATOR}`。"
+        )
+        batch_text = openrouter_chat(
+            model="perplexity/sonar-pro",
+            messages=[{"role":"user","content":prompt}]
+        )
+        sections = [part.strip() for part in batch_text.split(FIELD_SEPARATOR)] if batch_text else []
+        # 去除開頭/結尾多出的分隔標記造成的空段落
+        while sections and not sections[0]:
+            sections.pop(0)
+        while sections and not sections[-1]:
+            sections.pop()
+        # 段落數與領域數不符時無法確定對應關係，整批視為失敗，也不寫入快取
+        if len(sections) != len(pending):
+            if batch_text:
+                print(f"Batch split mismatch: expected {len(pending)} sections, got {len(sections)}")
+            sections = []
+        for (field, query_vector), section in zip(pending, sections):
+            if not section:
+                continue
+            results[field] = section
+            if query_vector is not None:
+                store_topic_cache(field, query_vector, section)
+
+    return {field: results.get(field) for field in fields}
+
+def search_with_perplexity_stream(topic):
+    prompt = _RESEARCH_TPL.safe_substitute(topic=topic)
     return openrouter_chat(
+        model="perplexity/sonar-deep-research",
+        messages=[{"role": "user", "content": prompt}],
+        stream=True
+    )
+
+async def search_with_perplexity_async(async_client, topic):
+    prompt = _RESEARCH_TPL.safe_substitute(topic=topic)
+    return await openrouter_chat_async(
+        async_client,
         model="perplexity/sonar-deep-research",
         messages=[{"role": "user", "content": prompt}]
     )
 
-def generate_video_script(topic, final_summary):
-    prompt = SCRIPT_PROMPT_TEMPLATE.format(topic=topic, final_summary=final_summary)
+def generate_video_script_stream(topic, final_summary):
+    prompt = _SCRIPT_TPL.safe_substitute(topic=topic, final_summary=final_summary)
     return openrouter_chat(
         model="anthropic/claude-3.5-sonnet", # 使用更擅長創意寫作的模型
         messages=[{"role":"user","content":prompt}],
-        temperature=0.8
+        temperature=0.8,
+        stream=True
     )
 
+def extract_topic_titles(text):
+    """
+    從議題清單文本中取出各議題的建議標題。
+    依模板結構，每個議題都是「#### 標題」後接「1. 核心內容摘要」，
+    因此只取每個核心內容摘要之前最近的 #### 標題；
+    不依賴議題之間是否有 --- 分隔，也不會把其他四級小標誤當成議題。
+    """
+    titles = []
+    heading = None
+    for line in (text or "").splitlines():
+        match = re.match(r'^\s*####\s*(.+)$', line)
+        if match:
+            heading = match.group(1)
+        elif heading and "核心內容摘要" in line:
+            title = _URL_RE.sub("", heading).replace("**", "").strip(" ✅❌⚠️")
+            if title:
+                titles.append(title)
+            heading = None
+    return titles
+
 def verify_links_in_text(text):
     """驗證文本中的連結並附加狀態圖示"""
     if not text: return ""
     
-    urls = re.findall(r'https?://[^\s\)\>]+', text)
-    if not urls:
+    # 依文中出現順序取得不重複的連結
+    unique_urls = list(dict.fromkeys(m.group(0) for m in _URL_RE.finditer(text)))
+    if not unique_urls:
         return text
 
-    verified_text = text
-    with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-        future_to_url = {executor.submit(check_url_status, url): url for url in set(urls)}
-        url_statuses = {}
-        for future in concurrent.futures.as_completed(future_to_url):
-            url = future_to_url[future]
-            try:
-                is_valid = future.result()
-                url_statuses[url] = "✅" if is_valid else "❌"
-            except Exception:
-                url_statuses[url] = "⚠️"
+    # 只驗證快取中沒有或已過期的連結，避免 Streamlit 每次重跑都重新發送請求
+    cache = st.session_state.url_status_cache
+    now = time.time()
+    to_check = [u for u in unique_urls if u not in cache or now - cache[u][1] > URL_STATUS_TTL]
 
-    for url, status in url_statuses.items():
-        verified_text = verified_text.replace(url, f'{url} {status}')
-    
-    return verified_text
+    # 無法通過預先檢查的連結直接標示為無效，不發送請求
+    reachable = []
+    for url in to_check:
+        if is_checkable_url(url):
+            reachable.append(url)
+        else:
+            cache[url] = ("❌", now)
+    if reachable:
+        for url, status in asyncio.run(verify_all(reachable)).items():
+            cache[url] = (status, now)
+
+    url_statuses = {u: cache[u][0] for u in unique_urls}
+
+    # 單次掃描替換：每個連結只會被標註一次，也不會誤標註以其為前綴的較長連結
+    return _URL_RE.sub(lambda m: f"{m.group(0)} {url_statuses[m.group(0)]}", text)
 
 # ==============================
 # 🖼️ Streamlit 介面佈局
 # ==============================
+# --- 各分頁的顯示區塊；標註 st.fragment 者，其中的互動只會重跑該區塊 ---
+@st.fragment
+def render_discovered_topics():
+    """推薦議題列表；其中的按鈕只會重跑此區塊"""
+    if st.session_state.discovered_topics_text:
+        st.divider()
+        st.subheader("推薦議題列表", anchor=False)
+        st.caption("✅: 連結有效 | ❌: 連結無效或無法訪問 | ⚠️: 驗證時發生錯誤")
+        with st.container(border=True):
+             st.markdown(st.session_state.discovered_topics_text, unsafe_allow_html=True)
+
+        # 一次針對所有推薦議題同時進行深度研究
+        topic_titles = extract_topic_titles(st.session_state.discovered_topics_text)
+        if topic_titles and st.button("🚀 研究全部推薦議題", help="同時對清單中的所有議題進行 Deep Research"):
+            stored_data = load_stored_data()
+            pending_topics = [t for t in topic_titles if t not in stored_data]
+            for t in topic_titles:
+                if t in stored_data:
+                    st.session_state.research_result[t] = stored_data[t]["perplexity_result"]
+            if pending_topics:
+                with st.spinner(f"🔍 正在同時研究 {len(pending_topics)} 個議題，過程可能需要 5-10 分鐘，請稍候..."):
+                    results = run_many([
+                        lambda c, t=t: search_with_perplexity_async(c, t) for t in pending_topics
+                    ])
+                for t, result in zip(pending_topics, results):
+                    if result:
+                        save_result(t, result)
+                        st.session_state.research_result[t] = result
+            notices = []
+            failed = [t for t, result in zip(pending_topics, results) if not result] if pending_topics else []
+            if failed:
+                notices.append(("error", f"以下議題研究失敗，請稍後再試：{'、'.join(failed)}"))
+            if not pending_topics or any(results):
+                notices.append(("success", "✅ 推薦議題研究完成！可至「Step 2」或「Step 3」查看與使用。"))
+
+            if pending_topics and any(results):
+                # 新的研究結果也要反映在 Step 2、Step 3 的區塊，因此整頁重跑，而非只重跑此區塊
+                st.session_state.batch_research_notices = notices
+                st.rerun(scope="app")
+            for kind, message in notices:
+                getattr(st, kind)(message)
+
+        for kind, message in st.session_state.batch_research_notices:
+            getattr(st, kind)(message)
+        st.session_state.batch_research_notices = []
+
+def render_research_result(topic):
+    """顯示指定主題的研究報告"""
+    if topic and topic in st.session_state.research_result:
+        st.divider()
+        st.subheader(f"📚 研究報告：{topic}", anchor=False)
+        with st.container(border=True):
+            st.markdown(st.session_state.research_result[topic])
+
+@st.fragment
+def render_script_generator():
+    """選擇主題與生成腳本；切換選項時只重跑此區塊"""
+    stored_data = load_stored_data()
+
+    # 讓使用者從已研究的主題中選擇
+    researched_topics = list(stored_data.keys())
+    if not researched_topics:
+        st.warning("目前尚無已完成的研究報告。請先在「Step 2: 主題研究」分頁完成至少一項研究。")
+    else:
+        selected_topic_for_script = st.selectbox(
+            "選擇一個已完成研究的主題來生成腳本：",
+            options=researched_topics,
+            index=None,
+            placeholder="請選擇..."
+        )
+
+        if st.button("✍️ 生成影片腳本", type="primary") and selected_topic_for_script:
+            final_summary = stored_data[selected_topic_for_script]["perplexity_result"]
+            with st.spinner(f"🎬 您的專屬腳本寫手正在為「{selected_topic_for_script}」撰寫腳本..."):
+                with st.container(border=True):
+                    try:
+                        video_script = st.write_stream(
+                            generate_video_script_stream(selected_topic_for_script, final_summary)
+                        )
+                    except LLMStreamError:
+                        video_script = None
+            if video_script:
+                st.success("✅ 影片腳本生成完成！")
+            else:
+                st.error("腳本生成失敗，請稍後再試。")
+
 # 創建三個分頁
 tab1, tab2, tab3 = st.tabs(["**Step 1: 🕵️ 探索高潛力影片議題**", "**Step 2: 🔍 深度議題研究**", "**Step 3: 🎬 影片腳本**"])
 
@@ -431,14 +1076,39 @@ with tab1:
                     st.session_state.topic_list = []
                     st.error("無法生成主題，請檢查 API 連線或稍後再試。")
 
-    if st.session_state.discovered_topics_text:
-        st.divider()
-        st.subheader("推薦議題列表", anchor=False)
-        st.caption("✅: 連結有效 | ❌: 連結無效或無法訪問 | ⚠️: 驗證時發生錯誤")
-        with st.container(border=True):
-             st.markdown(st.session_state.discovered_topics_text, unsafe_allow_html=True)
+    render_discovered_topics()
 
+    # --- 多領域比較模式：以單一請求同時探索多個領域 ---
+    st.divider()
+    with st.expander("🔀 多領域比較模式"):
+        compare_fields = st.multiselect(
+            "選擇要比較的領域：",
+            PREDEFINED_FIELDS[1:-1],
+            placeholder="請選擇兩個以上的領域..."
+        )
+        extra_fields = st.text_input("其他領域 (以逗號分隔，可留空)：", placeholder="例如：太空科技, 生技醫療")
+        # 同一領域重複選取/輸入時只送出一次，並保留原本順序
+        compare_fields = list(dict.fromkeys(
+            compare_fields + [f.strip() for f in re.split(r'[,，]', extra_fields) if f.strip()]
+        ))
+
+        if st.button("💡 比較多個領域的熱門議題"):
+            if len(compare_fields) < 2:
+                st.warning("請至少選擇或輸入兩個領域。")
+            else:
+                with st.spinner(f"🧠 正在同時掃描 {len(compare_fields)} 個領域..."):
+                    batch_results = discover_topics_batch(compare_fields)
+                    st.session_state.discovered_topics_by_field = {
+                        field: verify_links_in_text(text) for field, text in batch_results.items() if text
+                    }
+                missing = [field for field, text in batch_results.items() if not text]
+                if missing:
+                    st.error(f"以下領域無法生成主題，請稍後再試：{'、'.join(missing)}")
 
+        for field, text in st.session_state.discovered_topics_by_field.items():
+            st.subheader(f"📌 {field}", anchor=False)
+            with st.container(border=True):
+                st.markdown(text, unsafe_allow_html=True)
 
 
 # ------------------------------
@@ -451,28 +1121,36 @@ with tab2:
     topic_input_value = st.session_state.selected_topic if st.session_state.selected_topic else ""
     topic_input = st.text_input("請輸入或確認要研究的主題：", value=topic_input_value)
 
+    streamed_topic = None
     if st.button("🚀 開始深度研究", type="primary") and topic_input.strip():
+        stored_data = load_stored_data()
         # 檢查快取
         if topic_input in stored_data:
             st.info("偵測到此主題的歷史研究紀錄，將直接從快取載入。")
             perplexity_result = stored_data[topic_input]["perplexity_result"]
             st.session_state.research_result[topic_input] = perplexity_result
         else:
+            # 以串流方式即時顯示報告內容，不必等待整份報告完成
+            st.divider()
+            st.subheader(f"📚 研究報告：{topic_input}", anchor=False)
             with st.spinner(f"🔍 正在為您進行「{topic_input}」的 Deep Research，過程可能需要 5-10 分鐘，請稍候..."):
-                perplexity_result = search_with_perplexity(topic_input)
-                if perplexity_result:
-                    save_result(topic_input, perplexity_result)
-                    st.session_state.research_result[topic_input] = perplexity_result
-                    st.success("✅ 主題研究完成並已儲存！")
-                else:
-                    st.error("研究過程中發生錯誤，請稍後再試。")
+                with st.container(border=True):
+                    try:
+                        perplexity_result = st.write_stream(search_with_perplexity_stream(topic_input))
+                    except LLMStreamError:
+                        # 只儲存完整結束的報告，避免被截斷的內容進入快取
+                        perplexity_result = None
+            if perplexity_result:
+                save_result(topic_input, perplexity_result)
+                st.session_state.research_result[topic_input] = perplexity_result
+                streamed_topic = topic_input
+                st.success("✅ 主題研究完成並已儲存！")
+            else:
+                st.error("研究過程中發生錯誤，請稍後再試。")
 
-    # 顯示研究結果
-    if topic_input and topic_input in st.session_state.research_result:
-        st.divider()
-        st.subheader(f"📚 研究報告：{topic_input}", anchor=False)
-        with st.container(border=True):
-            st.markdown(st.session_state.research_result[topic_input])
+    # 顯示研究結果 (剛串流完成的報告已顯示過，不再重複)
+    if topic_input != streamed_topic:
+        render_research_result(topic_input)
 
 # ------------------------------
 # Tab 3：影片腳本
@@ -481,29 +1159,4 @@ with tab3:
     st.header("🎬 生成 YouTube 影片腳本")
     st.info("AI 將化身專業腳本寫手，根據第二步產出的深度研究報告，為您撰寫一份生動有趣的口語化逐字稿。")
 
-    # 讓使用者從已研究的主題中選擇
-    researched_topics = list(stored_data.keys())
-    if not researched_topics:
-        st.warning("目前尚無已完成的研究報告。請先在「Step 2: 主題研究」分頁完成至少一項研究。")
-    else:
-        selected_topic_for_script = st.selectbox(
-            "選擇一個已完成研究的主題來生成腳本：",
-            options=researched_topics,
-            index=None,
-            placeholder="請選擇..."
-        )
-
-        if st.button("✍️ 生成影片腳本", type="primary") and selected_topic_for_script:
-            final_summary = stored_data[selected_topic_for_script]["perplexity_result"]
-            with st.spinner(f"🎬 您的專屬腳本寫手正在為「{selected_topic_for_script}」撰寫腳本..."):
-                video_script = generate_video_script(selected_topic_for_script, final_summary)
-                if video_script:
-                    st.success("✅ 影片腳本生成完成！")
-                    with st.container(border=True):
-                        st.markdown(video_script)
-                else:
-                    st.error("腳本生成失敗，請稍後再試。")
-
-
-
-
+    render_script_generator()
@@ -0,0 +1,90 @@
+import json
+import os
+
+import httpx
+import openai
+from streamlit.testing.v1 import AppTest
+
+APP_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "AI_Research_Agent.py")
+
+TOPICS_TEXT = """
+### **YouTube 影片議題策略清單**
+
+#### AI 泡沫還是新常態
+- 標題草案
+**1. 核心內容摘要 (Content Summary):**
+- 摘要
+
+---
+
+#### 聯準會降息倒數
+- 標題草案
+**1. 核心內容摘要 (Content Summary):**
+- 摘要
+"""
+
+
+def _fake_openrouter(request):
+    """以固定內容回應 chat completion，報告內容包含請求中的主題"""
+    body = json.loads(request.content)
+    prompt = body["messages"][0]["content"]
+    topic = next(t for t in ("AI 泡沫還是新常態", "聯準會降息倒數") if t in prompt)
+    return httpx.Response(200, json={
+        "id": "test",
+        "object": "chat.completion",
+        "created": 0,
+        "model": body["model"],
+        "choices": [{
+            "index": 0,
+            "finish_reason": "stop",
+            "message": {"role": "assistant", "content": f"研究報告：{topic}"},
+        }],
+    })
+
+
+class _MockedAsyncOpenAI(openai.AsyncOpenAI):
+    def __init__(self, **kwargs):
+        kwargs["http_client"] = httpx.AsyncClient(transport=httpx.MockTransport(_fake_openrouter))
+        super().__init__(**kwargs)
+
+
+def test_research_all_topics_runs_end_to_end(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path) # 研究結果資料庫與 JSONL 紀錄檔寫在暫存目錄
+    monkeypatch.setattr(openai, "AsyncOpenAI", _MockedAsyncOpenAI)
+
+    at = AppTest.from_file(APP_FILE, default_timeout=30)
+    at.secrets["OPENROUTER_API_KEY"] = "test-key"
+    at.session_state["discovered_topics_text"] = TOPICS_TEXT
+    at.run()
+
+    next(b for b in at.button if b.label == "🚀 研究全部推薦議題").click().run()
+
+    assert not at.exception
+    assert not at.error, [e.value for e in at.error]
+    assert at.session_state["research_result"] == {
+        "AI 泡沫還是新常態": "研究報告：AI 泡沫還是新常態",
+        "聯準會降息倒數": "研究報告：聯準會降息倒數",
+    }
+    assert (tmp_path / "research_results.jsonl").read_text(encoding="utf-8").count("\n") == 2
+
+
+def test_research_all_takes_one_global_slot_per_topic(tmp_path, monkeypatch):
+    import streamlit as st
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(openai, "AsyncOpenAI", _MockedAsyncOpenAI)
+    monkeypatch.setenv("MAX_CONCURRENT_LLM", "1")
+    st.cache_resource.clear() # 重新建立只有一個名額的全域 semaphore
+
+    at = AppTest.from_file(APP_FILE, default_timeout=30)
+    at.secrets["OPENROUTER_API_KEY"] = "test-key"
+    at.session_state["discovered_topics_text"] = TOPICS_TEXT
+    at.run()
+
+    next(b for b in at.button if b.label == "🚀 研究全部推薦議題").click().run()
+
+    assert not at.exception
+    # 只有一個名額：第一個議題完成，第二個因額滿而未執行
+    assert at.session_state["research_result"] == {"AI 泡沫還是新常態": "研究報告：AI 泡沫還是新常態"}
+    assert any("聯準會降息倒數" in e.value for e in at.error)
+    st.cache_resource.clear()